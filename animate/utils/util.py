@@ -1,7 +1,11 @@
 import os
+import pickle
+import logging
 import imageio
 import numpy as np
-from typing import Union
+from collections.abc import Mapping
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torchvision
@@ -11,6 +15,7 @@ from safetensors import safe_open
 from tqdm import tqdm
 from einops import rearrange
 from animate.utils.convert_lora_safetensor_to_diffusers import convert_lora, convert_motion_lora_ckpt_to_diffusers
+from animate.utils.convert_from_ckpt import convert_ldm_unet_checkpoint, convert_ldm_clip_checkpoint, convert_ldm_vae_checkpoint
 from PIL import Image, ImageOps
 
 
@@ -36,7 +41,7 @@ def get_tensor_interpolation_method():
 
 def set_tensor_interpolation_method(is_slerp):
     global tensor_interpolation
-    tensor_interpolation = slerp if is_slerp else linear
+    tensor_interpolation = fast_slerp if is_slerp else linear
 
 def linear(v1, v2, t):
     return (1.0 - t) * v1 + t * v2
@@ -53,49 +58,99 @@ def slerp(
     omega = dot.acos()
     return (((1.0 - t) * omega).sin() * v0 + (t * omega).sin() * v1) / omega.sin()
 
+# Eberly, "A Fast and Accurate Algorithm for Computing SLERP":
+# sin(t*theta)/sin(theta) = t * (1 + b_1 * (1 + b_2 * (...))), b_i = (u_i * t^2 - v_i) * (cos(theta) - 1)
+# 截断到8项，最后一项乘以(1 + mu)补偿截断误差
+_SLERP_ONE_PLUS_MU = 1.90110745351730037
+_SLERP_U = [1.0 / (i * (2 * i + 1)) for i in range(1, 8)] + [_SLERP_ONE_PLUS_MU / (8 * 17)]
+_SLERP_V = [i / (2 * i + 1) for i in range(1, 8)] + [_SLERP_ONE_PLUS_MU * 8 / 17]
+
+def fast_slerp(
+    v0: torch.Tensor, v1: torch.Tensor, t: float, DOT_THRESHOLD: float = 0.9995
+) -> torch.Tensor:
+    # 与slerp结果一致，但不需要acos/sin，只在dot >= 0 (夹角不超过90度) 时级数足够精确
+    # 与slerp一样先归一化再求点积，点积用float32累加，fp16的大latent不会溢出
+    u0 = v0 / v0.norm()
+    u1 = v1 / v1.norm()
+    dot = (u0.float() * u1.float()).sum()
+    if not (v0.requires_grad or v1.requires_grad):
+        # 不需要梯度时dot只同步到host一次，系数用python float计算，device上只剩最后的加权求和
+        # 需要梯度时系数保留为tensor，梯度可以经过插值权重传回
+        dot = dot.item()
+    if abs(dot) > DOT_THRESHOLD:
+        return (1.0 - t) * v0 + t * v1
+    if dot < 0:
+        return slerp(v0, v1, t, DOT_THRESHOLD)
+    xm1 = dot - 1.0
+    d = 1.0 - t
+    sqr_t, sqr_d = t * t, d * d
+    c_t, c_d = 1.0, 1.0
+    for u, v in zip(reversed(_SLERP_U), reversed(_SLERP_V)):
+        c_t = 1.0 + (u * sqr_t - v) * xm1 * c_t
+        c_d = 1.0 + (u * sqr_d - v) * xm1 * c_d
+    return (d * c_d) * v0 + (t * c_t) * v1
+
 def zero_rank_print(s):
     if (not dist.is_initialized()) and (dist.is_initialized() and dist.get_rank() == 0): print("### " + s)
 
 
-def save_videos_grid(videos: torch.Tensor, path: str, rescale=False, n_rows=6, fps=None, save_every_image=False, dir_path=None):
+# 视频/图片编码所用的后台线程池
+_save_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+def _log_save_error(future):
+    # 异步写入的异常不会被调用方看到，在这里打印出来
+    exc = future.exception()
+    if exc is not None:
+        logging.error("save_videos_grid failed", exc_info=exc)
+
+def save_videos_grid(videos: torch.Tensor, path: str, rescale=False, n_rows=6, fps=None, save_every_image=False, dir_path=None, max_value=None, async_write=False):
+    # rescale: 输入范围为 [-1, 1]
+    # max_value: rescale为False时输入的最大值 (1.0 或 255.0)，为None时根据整个视频的最大值推断
+    # async_write: 为True时在后台线程中编码并返回Future，Future完成前调用方不应原地修改videos
     videos = rearrange(videos, "b c t h w -> t b c h w")
     video_length = videos.shape[0]
-    outputs = []
-    for i, x in enumerate(videos):
-        x = torchvision.utils.make_grid(x, nrow=n_rows)
-        x = x.transpose(0, 1).transpose(1, 2).squeeze(-1)
-        if rescale:
-            x = (x + 1.0) / 2.0  # -1,1 -> 0,1
-        if x.max() <= 1.0:
-            x = (x * 255).numpy().astype(np.uint8)
-        else:
-            x = x.numpy().astype(np.uint8)
-        
-        outputs.append(x)
-
+    if rescale:
+        scale, bias = 127.5, 127.5  # -1,1 -> 0,255
+    else:
+        if max_value is None:
+            max_value = 1.0 if videos.max() <= 1.0 else 255.0
+        scale, bias = 255.0 / max_value, 0.0
     # os.makedirs(os.path.dirname(path), exist_ok=True)
     if fps is None:
         fps = (video_length // 2) if video_length > 1 else 1
     
-    if path.endswith('.gif'):
-        imageio.mimsave(path, outputs, fps=fps, loop=0)
-    else:
-        imageio.mimsave(path, outputs, fps=fps, codec='libx264')
-    
+    dir_base_path = path[:-4]
     if save_every_image:
-        dir_base_path = path[:-4]
         os.makedirs(dir_base_path, exist_ok=True)
+
+    def grid_frames():
         for i, x in enumerate(videos):
             x = torchvision.utils.make_grid(x, nrow=n_rows)
             x = x.transpose(0, 1).transpose(1, 2).squeeze(-1)
-            if rescale:
-                x = (x + 1.0) / 2.0  # -1,1 -> 0,1
-            if x.max() <= 1.0:
-                x = (x * 255).numpy().astype(np.uint8)
-            else:
-                x = x.numpy().astype(np.uint8)
-            
-            Image.fromarray(x).save(f"{dir_base_path}/_{i}.png")
+            x = torch.mul(x, scale).add_(bias).clamp_(0, 255).to(torch.uint8).numpy()
+            if save_every_image:
+                Image.fromarray(x).save(f"{dir_base_path}/_{i}.png")
+            yield x
+
+    def write():
+        if path.endswith('.gif'):
+            imageio.mimsave(path, list(grid_frames()), fps=fps, loop=0)
+            return
+        # 边生成边写入，内存中只保留当前帧
+        writer = imageio.get_writer(path, fps=fps, codec='libx264', macro_block_size=1)
+        try:
+            for x in grid_frames():
+                writer.append_data(x)
+        finally:
+            writer.close()
+
+    if not async_write:
+        write()
+        return None
+    # 每帧png和视频都在同一个任务中写完，.result()返回即表示所有文件都已写好
+    future = _save_executor.submit(write)
+    future.add_done_callback(_log_save_error)
+    return future
 
 # DDIM Inversion
 @torch.no_grad()
@@ -118,17 +173,12 @@ def init_prompt(prompt, pipeline):
     return context
 
 
-def next_step(model_output: Union[torch.FloatTensor, np.ndarray], timestep: int,
-              sample: Union[torch.FloatTensor, np.ndarray], ddim_scheduler):
-    timestep, next_timestep = min(
-        timestep - ddim_scheduler.config.num_train_timesteps // ddim_scheduler.num_inference_steps, 999), timestep
-    alpha_prod_t = ddim_scheduler.alphas_cumprod[timestep] if timestep >= 0 else ddim_scheduler.final_alpha_cumprod
-    alpha_prod_t_next = ddim_scheduler.alphas_cumprod[next_timestep]
-    beta_prod_t = 1 - alpha_prod_t
-    next_original_sample = (sample - beta_prod_t ** 0.5 * model_output) / alpha_prod_t ** 0.5
-    next_sample_direction = (1 - alpha_prod_t_next) ** 0.5 * model_output
-    next_sample = alpha_prod_t_next ** 0.5 * next_original_sample + next_sample_direction
-    return next_sample
+def next_step(model_output: torch.FloatTensor, sample: torch.FloatTensor,
+              alpha_prod_t: torch.FloatTensor, alpha_prod_t_next: torch.FloatTensor):
+    # alpha_prod_t, alpha_prod_t_next 由ddim_loop预先在device上算好，这里不再访问调度器
+    next_sample = sample - (1 - alpha_prod_t).sqrt() * model_output
+    next_sample.mul_(alpha_prod_t.rsqrt() * alpha_prod_t_next.sqrt())
+    return next_sample.add_((1 - alpha_prod_t_next).sqrt() * model_output)
 
 
 def get_noise_pred_single(latents, t, context, unet):
@@ -136,26 +186,93 @@ def get_noise_pred_single(latents, t, context, unet):
     return noise_pred
 
 
+def ddim_inversion_step(unet, latent, t, context, alpha_prod_t, alpha_prod_t_next):
+    noise_pred = get_noise_pred_single(latent, t, context, unet)
+    return next_step(noise_pred, latent, alpha_prod_t, alpha_prod_t_next)
+
+_ddim_inversion_step_compiled = None
+
+def get_ddim_inversion_step_compiled():
+    # 各步shape相同，只需编译一次；reduce-overhead会用CUDA graph去掉逐步的kernel launch开销
+    # 第一次使用时才编译，import本模块时不调用torch.compile
+    global _ddim_inversion_step_compiled
+    if _ddim_inversion_step_compiled is None:
+        _ddim_inversion_step_compiled = torch.compile(ddim_inversion_step, dynamic=False, mode="reduce-overhead")
+    return _ddim_inversion_step_compiled
+
+
 @torch.no_grad()
-def ddim_loop(pipeline, ddim_scheduler, latent, num_inv_steps, prompt):
+def ddim_loop(pipeline, ddim_scheduler, latent, num_inv_steps, prompt, use_compile=True):
     context = init_prompt(prompt, pipeline)
     uncond_embeddings, cond_embeddings = context.chunk(2)
     all_latent = [latent]
     latent = latent.clone().detach()
-    for i in tqdm(range(num_inv_steps)):
-        t = ddim_scheduler.timesteps[len(ddim_scheduler.timesteps) - i - 1]
-        noise_pred = get_noise_pred_single(latent, t, cond_embeddings, pipeline.unet)
-        latent = next_step(noise_pred, t, latent, ddim_scheduler)
+    step_fn = get_ddim_inversion_step_compiled() if use_compile else ddim_inversion_step
+    # 调度器的查表在循环外一次完成，alphas放在latent所在的device上，循环内不再有标量索引
+    step_ratio = ddim_scheduler.config.num_train_timesteps // ddim_scheduler.num_inference_steps
+    timesteps = ddim_scheduler.timesteps.flip(0)[:num_inv_steps]
+    timesteps_device = timesteps.to(latent.device)
+    alphas_cumprod = ddim_scheduler.alphas_cumprod.to(latent.device)
+    final_alpha_cumprod = torch.as_tensor(ddim_scheduler.final_alpha_cumprod, device=latent.device)
+    prev_timesteps = (timesteps_device - step_ratio).clamp(max=999)
+    alpha_prod_t = torch.where(prev_timesteps >= 0, alphas_cumprod[prev_timesteps.clamp(min=0)], final_alpha_cumprod)
+    alpha_prod_t_next = alphas_cumprod[timesteps_device]
+    # t也取device上的tensor，CPU输入会让inductor跳过CUDA graph
+    for i, t in enumerate(tqdm(timesteps_device)):
+        latent = step_fn(pipeline.unet, latent, t, cond_embeddings, alpha_prod_t[i], alpha_prod_t_next[i])
+        if use_compile:
+            # CUDA graph的输出缓冲会在下一次replay时被覆盖，保存前需要clone
+            latent = latent.clone()
         all_latent.append(latent)
     return all_latent
 
 
 @torch.no_grad()
-def ddim_inversion(pipeline, ddim_scheduler, video_latent, num_inv_steps, prompt=""):
-    ddim_latents = ddim_loop(pipeline, ddim_scheduler, video_latent, num_inv_steps, prompt)
+def ddim_inversion(pipeline, ddim_scheduler, video_latent, num_inv_steps, prompt="", use_compile=True):
+    ddim_latents = ddim_loop(pipeline, ddim_scheduler, video_latent, num_inv_steps, prompt, use_compile=use_compile)
     return ddim_latents
 
 
+class LazyStateDict(Mapping):
+    # 包装safe_open句柄的只读state dict，只在取值时才调用get_tensor读取对应tensor，
+    # 避免在转换前把整个checkpoint拷贝到内存。pop只移除key，供convert_ldm_unet_checkpoint使用
+    def __init__(self, handle):
+        self._handle = handle
+        self._keys = dict.fromkeys(handle.keys())
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return self._handle.get_tensor(key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def pop(self, key, *default):
+        if key not in self._keys:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self._keys[key]
+        return value
+
+
+def load_checkpoint_mmap(path):
+    # mmap方式加载checkpoint，只有真正被用到的tensor对应的页才会读入内存 (torch >= 2.1)
+    # 老版本torch、旧的非zip序列化格式或包含非tensor对象的checkpoint退回普通加载
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except (TypeError, RuntimeError, pickle.UnpicklingError):
+        return torch.load(path, map_location="cpu")
+
+
 def load_weights(
         animation_pipeline,
         # motion module
@@ -170,11 +287,12 @@ def load_weights(
     unet_state_dict = {}
     if motion_module_path != "":
         print(f"load motion module from {motion_module_path}")
-        motion_module_state_dict = torch.load(motion_module_path, map_location="cpu")
+        motion_module_state_dict = load_checkpoint_mmap(motion_module_path)
         motion_module_state_dict = motion_module_state_dict[
             "state_dict"] if "state_dict" in motion_module_state_dict else motion_module_state_dict
         unet_state_dict.update(
             {name: param for name, param in motion_module_state_dict.items() if "motion_modules." in name})
+        del motion_module_state_dict
 
     missing, unexpected = animation_pipeline.unet.load_state_dict(unet_state_dict, strict=False)
     assert len(unexpected) == 0
@@ -182,23 +300,25 @@ def load_weights(
 
     if dreambooth_model_path != "":
         print(f"load dreambooth model from {dreambooth_model_path}")
-        if dreambooth_model_path.endswith(".safetensors"):
-            dreambooth_state_dict = {}
-            with safe_open(dreambooth_model_path, framework="pt", device="cpu") as f:
-                for key in f.keys():
-                    dreambooth_state_dict[key] = f.get_tensor(key)
-        elif dreambooth_model_path.endswith(".ckpt"):
-            dreambooth_state_dict = torch.load(dreambooth_model_path, map_location="cpu")
-
-        # 1. vae
-        converted_vae_checkpoint = convert_ldm_vae_checkpoint(dreambooth_state_dict, animation_pipeline.vae.config)
-        animation_pipeline.vae.load_state_dict(converted_vae_checkpoint)
-        # 2. unet
-        converted_unet_checkpoint = convert_ldm_unet_checkpoint(dreambooth_state_dict, animation_pipeline.unet.config)
-        animation_pipeline.unet.load_state_dict(converted_unet_checkpoint, strict=False)
-        # 3. text_model
-        animation_pipeline.text_encoder = convert_ldm_clip_checkpoint(dreambooth_state_dict)
-        del dreambooth_state_dict
+        with ExitStack() as stack:
+            if dreambooth_model_path.endswith(".safetensors"):
+                # 按需读取tensor，safe_open句柄在转换结束前保持打开
+                f = stack.enter_context(safe_open(dreambooth_model_path, framework="pt", device="cpu"))
+                dreambooth_state_dict = LazyStateDict(f)
+            elif dreambooth_model_path.endswith(".ckpt"):
+                dreambooth_state_dict = torch.load(dreambooth_model_path, map_location="cpu")
+
+            # 1. vae
+            converted_vae_checkpoint = convert_ldm_vae_checkpoint(dreambooth_state_dict, animation_pipeline.vae.config)
+            animation_pipeline.vae.load_state_dict(converted_vae_checkpoint)
+            del converted_vae_checkpoint
+            # 2. unet
+            converted_unet_checkpoint = convert_ldm_unet_checkpoint(dreambooth_state_dict, animation_pipeline.unet.config)
+            animation_pipeline.unet.load_state_dict(converted_unet_checkpoint, strict=False)
+            del converted_unet_checkpoint
+            # 3. text_model
+            animation_pipeline.text_encoder = convert_ldm_clip_checkpoint(dreambooth_state_dict)
+            del dreambooth_state_dict
 
     if lora_model_path != "":
         print(f"load lora model from {lora_model_path}")
@@ -215,7 +335,7 @@ def load_weights(
         path, alpha = motion_module_lora_config["path"], motion_module_lora_config["alpha"]
         print(f"load motion LoRA from {path}")
 
-        motion_lora_state_dict = torch.load(path, map_location="cpu")
+        motion_lora_state_dict = load_checkpoint_mmap(path)
         motion_lora_state_dict = motion_lora_state_dict[
             "state_dict"] if "state_dict" in motion_lora_state_dict else motion_lora_state_dict
 
@@ -293,24 +413,29 @@ def apply_transforms(image, params=None):
 
     return image
 
+def get_square_face_boxes(face_rects, width, height, top_margin=0., bottom_margin=0.):
+    # face_rects: (B, 4) left, top, right, bottom
+    # 短边向两侧扩展补成正方形，再按top_margin/bottom_margin向上/下扩展，最后裁剪到图像范围
+    # 全部是tensor运算，不需要逐帧的python分支
+    face_rects = face_rects.float()
+    left, top, right, bottom = face_rects.unbind(-1)
+    face_w = right - left
+    face_h = bottom - top
+    pad = (face_h - face_w).abs() // 2
+    pad_w = torch.where(face_w < face_h, pad, torch.zeros_like(pad))
+    pad_h = pad - pad_w
+    delta_hight = face_h + 2 * pad_h
+    boxes = face_rects + torch.stack([-pad_w, -pad_h - top_margin * delta_hight, pad_w, pad_h + bottom_margin * delta_hight], dim=-1)
+    inf = float('inf')
+    return boxes.clamp(min=boxes.new_tensor([0., 0., -inf, -inf]), max=boxes.new_tensor([inf, inf, width, height]))
+
 def crop_and_resize_tensor(frame, target_size = (512, 512), crop_rect = None, center = None):
     # 假设 frame 是 (B, C, H, W) 的格式
     b, _, height, width = frame.shape
 
     if crop_rect is not None:
-        left, top, right, bottom = crop_rect
-        face_w = right - left
-        face_h = bottom - top
-        # padding = max(face_w, face_h) // 2
-        
-        if face_w < face_h:
-            left = left - (face_h - face_w) // 2
-            right = right + (face_h - face_w) // 2
-        else:
-            top = top - (face_w - face_h) // 2
-            bottom = bottom + (face_w - face_h) // 2
-        # left, top, right, bottom = left - padding, top - padding, right + padding, bottom + padding
-        left, top, right, bottom = max(left, 0), max(top, 0), min(right, width), min(bottom, height)
+        crop_rect = torch.stack([torch.as_tensor(v, dtype=torch.float32) for v in crop_rect]).reshape(1, 4)
+        left, top, right, bottom = get_square_face_boxes(crop_rect, width, height)[0].tolist()
 
     elif center is not None:
         # 假设已经给定了 center_x, center_y 以及原始图像的 width 和 height
@@ -334,7 +459,7 @@ def crop_and_resize_tensor(frame, target_size = (512, 512), crop_rect = None, ce
         top = (height - short_edge) // 2
         right = left + short_edge
         bottom = top + short_edge
-    
+
     frame_cropped = frame[:, :, int(top):int(bottom), int(left):int(right)].float()
     target_height, target_width = target_size
     frame_resized = torch.nn.functional.interpolate(frame_cropped, size=(target_height, target_width), mode='bilinear', align_corners=False)
@@ -369,90 +494,65 @@ def crop_and_resize_tensor_with_face_rects(pixel_values, faces, target_size = (5
     return min_face_size, all_face_rects, bbox, output_values
                 
 
+def get_first_face_rects(faces, num_frames):
+    # 每帧取第一个检测到的人脸框，返回 (num_frames, 4) 的 left, top, right, bottom，没有人脸的帧为 NaN
+    if 'image_ids' not in faces.keys() or faces['image_ids'].numel() == 0:
+        return torch.full((num_frames, 4), float('nan'))
+    image_ids = faces['image_ids'].long()
+    num_rects = image_ids.numel()
+    rect_index = torch.arange(num_rects, device=image_ids.device)
+    in_range = image_ids < num_frames
+    first_index = torch.full((num_frames,), num_rects, dtype=torch.long, device=image_ids.device)
+    first_index.scatter_reduce_(0, image_ids[in_range], rect_index[in_range], reduce='amin')
+    face_rects = faces['rects'].float()[first_index.clamp(max=num_rects - 1)]
+    face_rects[first_index == num_rects] = float('nan')
+    return face_rects
+
+
 def crop_and_resize_tensor_face(pixel_values : torch.Tensor,
                         target_size = (512, 512),
-                        crop_face_center = True, face_detector = None) -> torch.Tensor:
+                        crop_face_center = True, face_detector = None, device = "cuda") -> torch.Tensor:
     # 和crop_and_resize_tensor_face 一样，但是把人脸放到中间，并且裁剪人脸大小占整个图像的0.25
-    pixel_values = pixel_values.to("cuda")
-    pixel_values_det = pixel_values.clone()
+    # 在device上做检测和裁剪，结果返回到输入所在的设备；输入已在device上时不做拷贝
+    orig_device = pixel_values.device
+    pixel_values = pixel_values.to(device, non_blocking=True)
     assert face_detector is not None
-    face_stride = len(pixel_values_det) // 32
+    face_stride = len(pixel_values) // 32
     if face_stride == 0:
         face_stride += 1
-    faces = face_detector(pixel_values_det[::face_stride])
+    # 检测器不会修改输入，直接传入切片视图
+    faces = face_detector(pixel_values[::face_stride])
     if 'image_ids' not in faces.keys() or faces['image_ids'].numel() == 0 or not crop_face_center:
-        pixel_values = crop_and_resize_tensor(pixel_values_det, target_size=target_size)
+        pixel_values, bbox = crop_and_resize_tensor(pixel_values, target_size=target_size)
         # print("no face find in first frame")
     else:
         L, __, H, W = pixel_values.shape
-        l, t, r, b = W, H, 0, 0
-        for i in range(L):
-            face_rects = []
-            for j, ids in enumerate(faces['image_ids']):
-                if i == ids:
-                    face_rects.append(faces['rects'][j])
-            if len(face_rects) == 0:
-                continue
-            face_rect = face_rects[0]
-            left, top, right, bottom = face_rect
-            l = min(left, l)
-            t = min(top, t)
-            r = max(r, right)
-            b = max(b, bottom)
-            center_x, center_y = (l + r) // 2, (t + b) // 2
+        face_rects = get_first_face_rects(faces, L)
+        face_rects = face_rects[~torch.isnan(face_rects[:, 0])]
+        l = min(face_rects[:, 0].min(), W)
+        t = min(face_rects[:, 1].min(), H)
+        r = max(face_rects[:, 2].max(), 0)
+        b = max(face_rects[:, 3].max(), 0)
+        center_x, center_y = (l + r) // 2, (t + b) // 2
 
         pixel_values, bbox = crop_and_resize_tensor(pixel_values, target_size=target_size, center=(center_x, center_y))
 
-    return pixel_values.cpu()
+    return pixel_values.to(orig_device)
 
 def crop_move_face(frames, faces, target_size = (512, 512), top_margin=0.4, bottom_margin=0.1):
     # 将除要裁剪的人脸以外的其他区域全部保留下来，但是涂成黑色，只有人脸区域保留
     # is_get_head: 是否获取包含更多头部（发际线以上的部位作为Condition）
     # 假设 frame 是 (B, C, H, W) 的格式
     L = frames.shape[0]
-    output_sequence = list()
-    b, channels, height, width = frames.shape
-    all_face_rects = []
-    for i in range(L):
-        frame = frames[i: i + 1]
-        face_rects = []
-        for j, ids in enumerate(faces['image_ids']):
-            if i == ids:
-                face_rects.append(faces['rects'][j])
-        if len(face_rects) == 0:
-            if len(all_face_rects) > 0:
-                face_rects = [all_face_rects[-1]]
-            else:
-                return None, None, None, None
-        face_rect = face_rects[0]
-        all_face_rects.append(face_rect)
-        left, top, right, bottom = face_rect
-        face_w = right - left
-        face_h = bottom - top
-        # padding = max(face_w, face_h) // 2
-        
-        if face_w < face_h:
-            left = left - (face_h - face_w) // 2
-            right = right + (face_h - face_w) // 2
-        else:
-            top = top - (face_w - face_h) // 2
-            bottom = bottom + (face_w - face_h) // 2
-
-        delta_hight = (bottom - top)
-        top -= top_margin * delta_hight
-        bottom += bottom_margin * delta_hight
-        left, top, right, bottom = max(left, 0), max(top, 0), min(right, width), min(bottom, height)
-        
-        frame_cropped = torch.zeros_like(frame).float()
-        move_face = frame[:, :, int(top):int(bottom), int(left):int(right)].float()
-        frame_cropped[:, :, int(top):int(bottom), int(left):int(right)] = move_face
-        # frame_cropped = frame_cropped[:, :, ptop: pbottom, pleft: pright]
-
-        target_height, target_width = target_size
-        frame_resized = torch.nn.functional.interpolate(frame_cropped, size=(target_height, target_width), mode='bilinear', align_corners=False)
-        output_sequence.append(frame_resized)
-    output_frames = torch.cat(output_sequence, dim=0)
-    return output_frames
+    face_rects = get_first_face_rects(faces, L)
+    has_face = ~torch.isnan(face_rects[:, 0])
+    if not has_face[0]:
+        return None, None, None, None
+    # 没有检测到人脸的帧沿用前一帧的人脸框
+    last_face_index = torch.where(has_face, torch.arange(L, device=has_face.device), 0).cummax(dim=0).values
+    face_rects = face_rects[last_face_index]
+    return crop_move_face_batch(frames, face_rects, target_size=target_size,
+                                is_get_head=True, top_margin=top_margin, bottom_margin=bottom_margin)
 
 
 # def crop_move_face(frames, faces, p_bbox, target_size = (512, 512), top_margin=0.4, bottom_margin=0.1):
@@ -558,6 +658,22 @@ def get_patch_div(x_mean, y_mean, H, W, n):
 
     return int(xmin), int(xmax), int(ymin), int(ymax)
 
+def get_patch_div_array(x_mean, y_mean, H, W, n):
+    # get_patch_div 的向量化版本，x_mean, y_mean可以是任意shape的数组，一次计算所有中心点的矩形
+    half_height = H / n
+    half_width = W / n
+
+    xmin = np.maximum(0, x_mean - half_width)
+    xmax = np.minimum(W, x_mean + half_width)
+    ymin = np.maximum(0, y_mean - half_height)
+    ymax = np.minimum(H, y_mean + half_height)
+
+    return xmin.astype(np.int64), xmax.astype(np.int64), ymin.astype(np.int64), ymax.astype(np.int64)
+
+def get_patch_025(x_mean, y_mean, H, W):
+    # 生成大小为H/4,W/4的矩形
+    return get_patch_div_array(x_mean, y_mean, H, W, 8)
+
 def get_025_gaze_mouth(control:torch.Tensor, 
                     origin_video:torch.Tensor, 
                     dwpose_model, 
@@ -568,38 +684,27 @@ def get_025_gaze_mouth(control:torch.Tensor,
     # control: b, c, h, w
     # origin_video: b c h w
     # return control_condition (fix with ref-image), origin control video after crop
+    # 原始的control原样返回 (b c h w tensor)，需要 b h w c numpy 的调用方自行转换
     # is_get_head 是否多裁一些人脸，让头部也保留，只在move_face为True的时候有用
     H, W = control.shape[2:]
-    control_crop = control.clone()
-    control = rearrange(control, "b c h w -> b h w c")
-    control = control.numpy() # b h w c, numpy
-    if 'image_ids' not in faces.keys() or faces['image_ids'].numel() == 0:
-        face_rect = [None] * len(control_crop)
-    else:
-        face_rect = []
-        for i in range(len(control_crop)):
-            for j, ids in enumerate(faces['image_ids']):
-                if i == ids:
-                    face_rect.append(faces['rects'][j])
-                    break
-            if len(face_rect) == i:
-                face_rect.append(None)                                                
-    face_image_list = []
+    control_crop = control
+    face_rect = get_first_face_rects(faces, len(control_crop))
+    has_face = (~torch.isnan(face_rect[:, 0])).tolist()
+    face_images = torch.empty(len(control_crop), control_crop.shape[1], *target_size, device=control_crop.device)
     for i, face_rect_item in enumerate(face_rect):
-        face_image = crop_move_face(control_crop[i].unsqueeze(0), 
+        face_images[i:i + 1] = crop_move_face_org(control_crop[i].unsqueeze(0), 
                                     target_size=target_size, 
-                                    crop_rect=face_rect_item, 
+                                    crop_rect=face_rect_item if has_face[i] else None, 
                                     is_get_head=is_get_head)            
-        face_image_list.append(face_image)
     
     # 获取source image和control condition的landmark，并进行基于眼睛和嘴巴中心的对齐
-    control_crop = rearrange(control_crop, "b c h w -> b h w c").numpy()
-    control_crop = control_crop.astype("uint8")
-    origin_video = rearrange(origin_video, "b c h w -> b h w c")
-    origin_video = origin_video[0].numpy() # h w c, numpy
+    # 只用到第一帧，只转换这一帧
+    control_first = rearrange(control_crop[0], "c h w -> h w c").numpy().astype("uint8")
+    origin_video = rearrange(origin_video[0], "c h w -> h w c")
+    origin_video = origin_video.numpy() # h w c, numpy
     _, __, source_landmark = dwpose_model.dwpose_model(origin_video, output_type='np', image_resolution=H, get_mark=True)
     source_landmark = source_landmark["faces_all"][0] * target_size[0]
-    _, __, control_landmark = dwpose_model.dwpose_model(control_crop[0], output_type='np', image_resolution=H, get_mark=True)
+    _, __, control_landmark = dwpose_model.dwpose_model(control_first, output_type='np', image_resolution=H, get_mark=True)
     control_landmark = control_landmark["faces_all"][0] * target_size[0]
     src_point = control_landmark
     right, bottom = src_point[:, :].max(axis=0)
@@ -612,26 +717,24 @@ def get_025_gaze_mouth(control:torch.Tensor,
     
     transform_matrix = cv2.getAffineTransform(np.float32(src_point), np.float32(dist_point))
     # 获取对齐矩阵后，再将moveFace结果进行转移
-    control_crop = torch.cat(face_image_list).cpu()
+    control_crop = face_images.cpu()
     control_crop = rearrange(control_crop, "b c h w -> b h w c").numpy().astype('uint8')
     # 转移完moveFace的结果后，再获取025的gaze_mouth
-    frame_gaze_list = []
+    ldms = []
     for control_item in control_crop:
         _, __, ldm = dwpose_model.dwpose_model(control_item, output_type='np', image_resolution=target_size[0], get_mark=True)
-        ldm = ldm["faces_all"][0] * target_size[0]
-        frame_gaze = np.zeros_like(control_item)
-        x_mean, y_mean = np.mean(ldm[60 - 24: 66 - 24], axis=0) # left eyes
-        xmin, xmax, ymin, ymax = get_patch_025(x_mean, y_mean, target_size[0], target_size[1])
-        frame_gaze[int(ymin):int(ymax), int(xmin):int(xmax), :] = control_item[int(ymin):int(ymax), int(xmin):int(xmax), :]
-        
-        x_mean, y_mean = np.mean(ldm[66 - 24: 72 - 24], axis=0) # right eyes
-        xmin, xmax, ymin, ymax = get_patch_025(x_mean, y_mean, target_size[0], target_size[1])
-        frame_gaze[int(ymin):int(ymax), int(xmin):int(xmax), :] = control_item[int(ymin):int(ymax), int(xmin):int(xmax), :]
-        x_mean, y_mean = np.mean(ldm[72 - 24: 92 - 24], axis=0) # mouth
-        xmin, xmax, ymin, ymax = get_patch_025(x_mean, y_mean, target_size[0], target_size[1])
-        frame_gaze[int(ymin):int(ymax), int(xmin):int(xmax), :] = control_item[int(ymin):int(ymax), int(xmin):int(xmax), :]
-        frame_gaze_list.append(frame_gaze)
-    frame_gaze_list = np.array(frame_gaze_list).astype('uint8')    
+        ldms.append(ldm["faces_all"][0] * target_size[0])
+    ldms = np.stack(ldms) # b 68 2
+    centers = np.stack([ldms[:, 60 - 24: 66 - 24].mean(axis=1), # left eyes
+                        ldms[:, 66 - 24: 72 - 24].mean(axis=1), # right eyes
+                        ldms[:, 72 - 24: 92 - 24].mean(axis=1)], # mouth
+                       axis=1) # b 3 2
+    xmin, xmax, ymin, ymax = get_patch_025(centers[..., 0], centers[..., 1], target_size[0], target_size[1])
+    # 所有帧的三个patch一次性生成mask
+    ys, xs = np.ogrid[:control_crop.shape[1], :control_crop.shape[2]]
+    mask = ((ys >= ymin[..., None, None]) & (ys < ymax[..., None, None]) &
+            (xs >= xmin[..., None, None]) & (xs < xmax[..., None, None])).any(axis=1) # b h w
+    frame_gaze_list = np.where(mask[..., None], control_crop, 0).astype('uint8')
     # 转移完后再使用对齐矩阵进行对齐操作
     control_aligns = []
     frame_gaze_aligns = []
@@ -692,17 +795,44 @@ def crop_move_face_org(
     if mask_rate != 0. and cur_mask_rate < use_mask_rate:
         num_patches_per_dim = 16
         patch_size = target_height // num_patches_per_dim
-        mask = torch.zeros(target_height, target_width)
-        mask_rect_rate = torch.rand(num_patches_per_dim, num_patches_per_dim)
-        for i in range(num_patches_per_dim):
-            for j in range(num_patches_per_dim):
-                if mask_rect_rate[i, j] < mask_rate:
-                    mask[i*patch_size:(i+1)*patch_size, j*patch_size:(j+1)*patch_size] = 1.
-        mask = mask.to(dtype=torch.bool)
-        frame_resized[:, :, mask] = 0.
+        # 一次性采样16x16的patch掩码，再上采样到patch大小，避免逐patch的python循环
+        mask_rect = torch.rand(num_patches_per_dim, num_patches_per_dim, device=frame_resized.device) < mask_rate
+        mask_rect = mask_rect.repeat_interleave(patch_size, dim=0).repeat_interleave(patch_size, dim=1)
+        # patch_size向下取整时，剩余的右/下边缘不做mask，与原逐patch写法保持一致
+        mask = torch.zeros(target_height, target_width, dtype=torch.bool, device=frame_resized.device)
+        mask_rect = mask_rect[:target_height, :target_width]
+        mask[:mask_rect.shape[0], :mask_rect.shape[1]] = mask_rect
+        frame_resized.masked_fill_(mask[None, None], 0.)
 
     return frame_resized
 
+def crop_move_face_batch(
+    frames : torch.Tensor,
+    face_rects : torch.Tensor,
+    target_size = (512, 512),
+    is_get_head=False, top_margin=0.4, bottom_margin=0.1) -> torch.Tensor:
+    # crop_move_face_org的批量版本 (不含mask/color jitter)，所有帧一次完成
+    # frames: (B, C, H, W), face_rects: (B, 4) left, top, right, bottom, 没有人脸的帧为 NaN
+    b, channels, height, width = frames.shape
+    face_rects = face_rects.to(device=frames.device, dtype=torch.float32)
+    has_face = ~torch.isnan(face_rects[:, 0])
+    if not is_get_head:
+        top_margin, bottom_margin = 0., 0.
+    boxes = get_square_face_boxes(face_rects, width, height, top_margin=top_margin, bottom_margin=bottom_margin)
+    # 没有人脸时与crop_move_face_org一致，只保留左上角 2x2 区域
+    boxes = torch.where(has_face[:, None], boxes, boxes.new_tensor([0., 0., 2., 2.]))
+    boxes = boxes.trunc().long()
+
+    ys = torch.arange(height, device=frames.device)[None, :, None]
+    xs = torch.arange(width, device=frames.device)[None, None, :]
+    mask = (ys >= boxes[:, 1, None, None]) & (ys < boxes[:, 3, None, None]) \
+        & (xs >= boxes[:, 0, None, None]) & (xs < boxes[:, 2, None, None])
+    # 只分配一份float32缓冲后原地置零；输入已是float32时.float()不会拷贝，所以显式copy=True
+    frame_cropped = frames.to(torch.float32, copy=True).masked_fill_(~mask[:, None], 0.)
+
+    target_height, target_width = target_size
+    return torch.nn.functional.interpolate(frame_cropped, size=(target_height, target_width), mode='bilinear', align_corners=False)
+
 def get_condition_face(control:torch.Tensor, 
                     origin_video:torch.Tensor, 
                     dwpose_model, 
@@ -713,32 +843,19 @@ def get_condition_face(control:torch.Tensor,
     # control: b, c, h, w
     # origin_video: b c h w
     # return control_condition (fix with ref-image), origin control video after crop
+    # 原始的control原样返回 (b c h w tensor)，需要 b h w c numpy 的调用方自行转换
     # is_get_head 是否多裁一些人脸，让头部也保留，只在move_face为True的时候有用
     H, W = control.shape[2:]
-    control_crop = control.clone()
-    control = rearrange(control, "b c h w -> b h w c")
-    control = control.cpu().numpy() # b h w c, numpy
-    faces = face_detector(control_crop.to(device=local_rank, dtype=weight_type))
-    if 'image_ids' not in faces.keys() or faces['image_ids'].numel() == 0:
-        face_rect = [None] * len(control_crop)
-    else:
-        face_rect = []
-        for i in range(len(control_crop)):
-            for j, ids in enumerate(faces['image_ids']):
-                if i == ids:
-                    face_rect.append(faces['rects'][j])
-                    break
-            if len(face_rect) == i:
-                face_rect.append(None)                                                
-    face_image_list = []
-    for i, face_rect_item in enumerate(face_rect):
-        face_image = crop_move_face_org(control_crop[i].unsqueeze(0), 
-                                    target_size=target_size, 
-                                    crop_rect=face_rect_item, 
-                                    is_get_head=is_get_head)            
-        face_image_list.append(face_image)
+    control_crop = control
+    # 先拷到device再在device上转dtype，避免在CPU上做float16转换；
+    # 调用方传入pin_memory()的tensor时，拷贝可以与之前的工作重叠
+    faces = face_detector(control_crop.to(device=local_rank, non_blocking=True).to(dtype=weight_type))
+    face_rect = get_first_face_rects(faces, len(control_crop))
+    control_crop = crop_move_face_batch(control_crop, face_rect, 
+                                        target_size=target_size, 
+                                        is_get_head=is_get_head)
     
-    control_crop = torch.cat(face_image_list).cpu()
+    control_crop = control_crop.cpu()
     control_crop = rearrange(control_crop, "b c h w -> b h w c").numpy()
 
     if is_get_gaze:
@@ -759,22 +876,38 @@ def get_condition_face(control:torch.Tensor,
 
     return control_crop, control                
 
+import shutil
 import subprocess
-import threading
+import tempfile
 def get_checkpoint(path):
-    base_path = path.split("/")[-1]
     if path.find("s3://") == -1:
-        return torch.load(path, map_location="cpu")
+        return load_checkpoint_mmap(path)
     else:
-        subprocess.run(['aws',
-                        f'--endpoint-url=http://oss.hh-b.brainpp.cn',
-                        's3',
-                        'cp',
-                        path,
-                        f"./"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-        ans = torch.load(f"./{base_path}", map_location="cpu")
-        def remove():
-            subprocess.run(['rm', '-rf', f"./{base_path}"], check=True)
-        thread = threading.Thread(target=remove)
-        thread.start()
-        return ans
+        # 直接从aws cli的stdout读取，不再落盘再读回、删除
+        # torch.load的zip格式需要可seek的文件，小于64MB时放在内存，更大的自动转存到临时文件，
+        # 避免序列化数据和反序列化后的tensor同时占用内存
+        proc = subprocess.Popen(['aws',
+                                 f'--endpoint-url=http://oss.hh-b.brainpp.cn',
+                                 's3',
+                                 'cp',
+                                 path,
+                                 '-'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        with tempfile.SpooledTemporaryFile(max_size=64 << 20) as buffer:
+            try:
+                shutil.copyfileobj(proc.stdout, buffer, 4 << 20)
+            except BaseException:
+                # 拷贝出错 (如磁盘写满、KeyboardInterrupt) 时结束aws进程，不留下僵尸进程
+                proc.kill()
+                raise
+            finally:
+                proc.stdout.close()
+                proc.wait()
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+            buffer.seek(0)
+            try:
+                return torch.load(buffer, map_location="cpu", weights_only=True)
+            except pickle.UnpicklingError:
+                # 包含非tensor对象的checkpoint，与本地路径一样退回普通加载
+                buffer.seek(0)
+                return torch.load(buffer, map_location="cpu")
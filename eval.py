@@ -15,7 +15,7 @@ from collections import OrderedDict
 import torch
 import torch.nn.functional as F
 
-from animate.utils.util import save_videos_grid, pad_image, crop_move_face, crop_and_resize_tensor_with_face_rects, crop_and_resize_tensor, wide_crop_face, get_patch_div
+from animate.utils.util import save_videos_grid, pad_image, crop_move_face, crop_and_resize_tensor_with_face_rects, crop_and_resize_tensor, wide_crop_face, get_patch_div_array
 from animate.utils.util import crop_and_resize_tensor_face
 from accelerate.utils import set_seed
 from animate.utils.videoreader import VideoReader
@@ -110,36 +110,25 @@ def eval(source_path, driver_path,
         right, bottom = dist_point[:, :].max(axis=0)
         left, top = dist_point[:, :].min(axis=0)
         dist_point = np.array([[left, top], [right, bottom], [left, bottom]]).astype("int32")
-        control_frames = []
-        patch_indices = [[1e6, 0, 1e6, 0], ] * 4
-
+        ldms = []
         for frame_index in range(video_length):
             cur_control = control_crop[frame_index]
             _, __, ldm = dwpose_model.dwpose_model(cur_control, output_type='np', image_resolution=size[0], get_mark=True)
-            ldm = ldm["faces_all"][0] * size[0]
-
-            for patch_idx, (kp_index_begin, kp_index_end, div_n) in enumerate([(36, 42, 8), (42, 48, 8), (48, 68, 8), (17, 27, 8)]):
-                xmin, xmax, ymin, ymax = patch_indices[patch_idx]
-                x_mean, y_mean = np.mean(ldm[kp_index_begin: kp_index_end], axis=0) # left eyes
-                left, right, top, bottom = get_patch_div(x_mean, y_mean, size[0], size[1], div_n)
-                xmin = min(xmin, left)
-                xmax = max(xmax, right)
-                ymin = min(ymin, top)
-                ymax = max(ymax, bottom)
-                patch_indices[patch_idx] = [xmin, xmax, ymin, ymax]
-
-        for frame_index in range(video_length):
-            cur_control = control_crop[frame_index]
-            # masked_frame = cur_control / 2
-            masked_frame = np.zeros_like(cur_control)
-            for xmin, xmax, ymin, ymax in patch_indices:
-                masked_frame[int(ymin):int(ymax), int(xmin):int(xmax), :] = cur_control[int(ymin):int(ymax), int(xmin):int(xmax), :]
-            control_frames.append(masked_frame)
-
-            if frame_index == 0:
-                right, bottom = ldm[:, :].max(axis=0)
-                left, top = ldm[:, :].min(axis=0)
-                src_point = np.array([[left, top], [right, bottom], [left, bottom]]).astype("int32")
+            ldms.append(ldm["faces_all"][0] * size[0])
+        ldms = np.stack(ldms) # f 68 2
+
+        # 所有帧的patch一次算出，再取并集
+        patch_mask = np.zeros(control_crop.shape[1:3], dtype=bool)
+        for kp_index_begin, kp_index_end, div_n in [(36, 42, 8), (42, 48, 8), (48, 68, 8), (17, 27, 8)]:
+            x_mean, y_mean = ldms[:, kp_index_begin: kp_index_end].mean(axis=1).T
+            left, right, top, bottom = get_patch_div_array(x_mean, y_mean, size[0], size[1], div_n)
+            patch_mask[top.min():bottom.max(), left.min():right.max()] = True
+        control_frames = np.where(patch_mask[None, :, :, None], control_crop, 0)
+
+        ldm = ldms[-1]
+        right, bottom = ldm[:, :].max(axis=0)
+        left, top = ldm[:, :].min(axis=0)
+        src_point = np.array([[left, top], [right, bottom], [left, bottom]]).astype("int32")
         transform_matrix = cv2.getAffineTransform(np.float32(src_point), np.float32(dist_point))
         control_frames = [torch.Tensor(cv2.warpAffine(item, transform_matrix, size)) for item in control_frames]
         pixel_values_pose = torch.stack(control_frames, dim=0).to(device, dtype=weight_type).permute(0, 3, 1, 2)
@@ -211,13 +200,13 @@ def eval(source_path, driver_path,
     if output_path != '':
         if os.path.exists(output_path):
             save_videos_grid(
-                samples_per_video[:, :, 1:, ...], f"{output_path}/{source_name}_{video_name}.mp4", save_every_image=False, fps=25)
+                samples_per_video[:, :, 1:, ...], f"{output_path}/{source_name}_{video_name}.mp4", save_every_image=False, fps=25, max_value=1.0)
         else:
             save_videos_grid(
-                samples_per_video[:, :, 1:, ...], f"{output_path}", save_every_image=False, fps=25)
+                samples_per_video[:, :, 1:, ...], f"{output_path}", save_every_image=False, fps=25, max_value=1.0)
     else:
         save_videos_grid(
-            samples_per_video[:, :, 1:, ...], f"./{source_name}_{video_name}.mp4", save_every_image=False, fps=25)
+            samples_per_video[:, :, 1:, ...], f"./{source_name}_{video_name}.mp4", save_every_image=False, fps=25, max_value=1.0)
     return model, image_processor, image_encoder
 
 if __name__ == "__main__":
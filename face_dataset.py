@@ -280,6 +280,7 @@ if __name__ == "__main__":
     ).with_length(len(dataset))
     from animate.utils.util import save_videos_grid
     cnt_num = 0
+    pending_save = None
     for data in tqdm(dataloader):
         seq = [
             data["swapped"], 
@@ -292,9 +293,14 @@ if __name__ == "__main__":
         samples_per_video = torch.cat(seq, dim=-2)
         samples_per_video = rearrange(samples_per_video, "b f c h w -> b c f h w")
         print('samples_per_video shape is', samples_per_video.shape, samples_per_video.min(), samples_per_video.max())
-        save_videos_grid(samples_per_video, f"./show_data/{cnt_num}.gif", rescale=True if samples_per_video.min() < 0 else False)
+        # 最多只有一个gif在后台编码，等上一个写完再提交，避免待写入的视频无限堆积
+        if pending_save is not None:
+            pending_save.result()
+        pending_save = save_videos_grid(samples_per_video, f"./show_data/{cnt_num}.gif", rescale=True if samples_per_video.min() < 0 else False, async_write=True)
         cnt_num += 1
         pass
+    if pending_save is not None:
+        pending_save.result()
  
     print("...")
     
\ No newline at end of file